@@ -3,17 +3,30 @@ from monitorcontrol import get_monitors,  Monitor
 import time
 import libusb_package
 from pydantic import BaseModel, Field
-from typing import List, Set, Dict, Tuple
+from typing import Callable, List, Dict, Tuple
 import usb.core
 from usb.core import Device
 import usb.backend.libusb1
+from usb.backend.libusb1 import _libusb_device_descriptor
 import struct
 import sys
+import ctypes
+import threading
+import atexit
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import glob
+import json
+import os
+import queue
+import shutil
 
 class MonitorState(str, Enum):
     DP1 = 'DP1'
-    DP2 = 'DP1'
-    DP3 = 'DP1'
+    DP2 = 'DP2'
+    DP3 = 'DP3'
     HDMI1 = 'HDMI1'
     HDMI2 = 'HDMI2'
     HDMI3 = 'HDMI3'
@@ -23,11 +36,14 @@ class MonitorConfig(BaseModel):
     name: str | None
     on_connect_state: MonitorState
     on_disconnect_state: MonitorState
+    monitor_id: str | None = None  # EDID-derived key from get_monitor_cache_key, used to match configs to monitors
     is_controllable: bool = True
+    last_known_state: MonitorState | None = Field(default=None, exclude=True)  # last input seen or set by this program
 
 class KVMConfig(BaseModel):
     usb_device: str
     enable_smart_switching: bool
+    force_resync_on_each_event: bool = True  # without smart switching, set every monitor's input even if it was last set to the target
     monitors: List[MonitorConfig]
 
 class KVMException(Exception):
@@ -37,88 +53,590 @@ class KVMException(Exception):
 
 libusb1_backend = usb.backend.libusb1.get_backend(find_library=libusb_package.find_library)
 WIN_PLATFORM = sys.platform == 'win32'
-monitor_config_map: Dict[str, MonitorConfig] = {}
+logger = logging.getLogger(__name__)
+monitor_config_map: Dict[str, MonitorConfig] = {}  # config paired with each monitor ID by the last build of monitor_plan
+monitor_config_lock = threading.RLock()  # serializes rebuilds of monitor_config_map and monitor_plan
+monitor_plan: List[Tuple[Monitor, MonitorConfig, str, str]] | None = None  # (monitor, config, on_connect, on_disconnect) per controllable monitor
 KVM_CONFIG = None
 
+LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED = 0x01
+LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT = 0x02
+LIBUSB_HOTPLUG_MATCH_ANY = -1
+LIBUSB_CAP_HAS_HOTPLUG = 0x0001
+libusb_hotplug_callback_fn = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+hotplug_callbacks: Dict[int, libusb_hotplug_callback_fn] = {}  # C callbacks by handle, referenced for as long as libusb may call them
+hotplug_thread: threading.Thread | None = None
+hotplug_stopped = threading.Event()
+usb_string_cache: Dict[Tuple[int, int, int, int], Tuple[str, str]] = {}
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'usb-kvm')
+CONTROLLABLE_CACHE_PATH = os.path.join(CACHE_DIR, 'controllable.json')
+CAPABILITIES_CACHE_PATH = os.path.join(CACHE_DIR, 'caps.json')
+disk_caches: Dict[str, dict] = {}  # contents of each cache file, loaded on first use
+session_controllable: Dict[str, bool] = {}  # probe results kept for this run only, by EDID key or else monitor ID
+cache_lock = threading.Lock()
+MAX_MONITOR_MATCH_ATTEMPTS = 10
+MAX_KVM_RESTARTS = 5
+KVM_HEALTHY_RUN_SECONDS = 300  # a run lasting this long resets the restart count and backoff
+usb_id_snapshot: frozenset | None = None  # connected (vendor_id, product_id) pairs, published by the USB snapshot thread
+usb_snapshot_version = 0  # incremented every time usb_id_snapshot changes
+usb_snapshot_changed = threading.Condition()
+usb_snapshot_stale = threading.Event()
+usb_snapshot_thread: threading.Thread | None = None
+
+
+@functools.lru_cache
+def parse_usb_device_id(device_id: str) -> Tuple[int, int]:
+    """
+        Parse a USB device ID in the format 'vendor_id:product_id' into its integer vendor and product IDs.
+        IDs are decimal unless prefixed with '0x', e.g. '6048:772' or '0x17a0:0x0304'.
+    """
+    vendor_id, product_id = (
+        int(part, 16) if part.strip().lower().startswith('0x') else int(part)
+        for part in device_id.split(':')
+    )
+    return vendor_id, product_id
+
+
+def enumerate_usb_ids() -> frozenset:
+    """
+        Returns the (vendor id, product id) of every connected USB device.
+        The libusb device list is walked directly rather than through usb.core.find, so no pyusb Device objects are built.
+    """
+    lib = libusb1_backend.lib
+    device_list = ctypes.POINTER(ctypes.c_void_p)()
+    count = lib.libusb_get_device_list(libusb1_backend.ctx, ctypes.byref(device_list))
+    if count < 0:
+        raise usb.core.USBError(f'libusb_get_device_list failed with {count}', errno=None, error_code=count)
+    try:
+        descriptor = _libusb_device_descriptor()
+        ids = set()
+        for i in range(count):
+            lib.libusb_get_device_descriptor(device_list[i], ctypes.byref(descriptor))
+            ids.add((descriptor.idVendor, descriptor.idProduct))
+        return frozenset(ids)
+    finally:
+        lib.libusb_free_device_list(device_list, 1)
+
+
+def refresh_usb_snapshot() -> bool:
+    """ Enumerates the connected USB devices into usb_id_snapshot, notifying waiters and returning true if they changed. """
+    global usb_id_snapshot, usb_snapshot_version
+    snapshot = enumerate_usb_ids()
+    with usb_snapshot_changed:
+        if snapshot == usb_id_snapshot:
+            return False
+        usb_id_snapshot = snapshot
+        usb_snapshot_version += 1
+        usb_snapshot_changed.notify_all()
+    return True
+
+
+def publish_usb_snapshots(hotplug_enabled: bool):
+    """
+        Keeps usb_id_snapshot up to date by re-enumerating after every hotplug event,
+        or when hotplug is unsupported, by polling with a backoff while nothing changes.
+        Enumeration errors are logged and retried with the same backoff, so the thread never dies and leaves waiters stuck.
+    """
+    idle_count = 0
+    while True:
+        if hotplug_enabled:
+            usb_snapshot_stale.wait()
+            usb_snapshot_stale.clear()
+        else:
+            time.sleep(get_usb_poll_interval(idle_count))
+        try:
+            changed = refresh_usb_snapshot()
+        except Exception:
+            logger.exception('Error enumerating USB devices. Retrying...')
+            idle_count += 1
+            if hotplug_enabled:
+                time.sleep(get_usb_poll_interval(idle_count))
+                usb_snapshot_stale.set()
+            continue
+        if changed:
+            idle_count = 0
+        else:
+            idle_count += 1
+
+
+def start_usb_snapshot_thread():
+    """ Takes the first USB snapshot and starts the background thread that keeps it up to date, unless already running. """
+    global usb_snapshot_thread
+    if usb_snapshot_thread is not None:
+        return
+    with usb_snapshot_changed:
+        if usb_snapshot_thread is not None:
+            return
+        hotplug_handle = register_usb_hotplug_callback(lambda event, key: usb_snapshot_stale.set())
+        refresh_usb_snapshot()
+        usb_snapshot_thread = threading.Thread(target=publish_usb_snapshots, args=(hotplug_handle is not None,), daemon=True)
+        usb_snapshot_thread.start()
+
+
+def wait_for_usb_snapshot(version: int) -> int:
+    """ Blocks until usb_id_snapshot has changed since the given usb_snapshot_version, and returns the new version. """
+    with usb_snapshot_changed:
+        while usb_snapshot_version == version:
+            usb_snapshot_changed.wait(timeout=1.0)  # untimed lock waits cannot be interrupted by Ctrl+C on Windows
+        return usb_snapshot_version
+
+
+def get_connected_usb_ids() -> frozenset:
+    """
+        Returns the (vendor_id, product_id) pairs of all connected USB devices.
+        They are read from the snapshot kept by the background USB snapshot thread, so callers never wait on an enumeration.
+    """
+    start_usb_snapshot_thread()
+    return usb_id_snapshot
+
+
+def is_usb_connected_ids(vendor_id: int, product_id: int) -> bool:
+    """ Check if a USB device is connected based on its already parsed vendor and product IDs. """
+    return (vendor_id, product_id) in get_connected_usb_ids()
+
+
 def is_usb_connected(device_id: str) -> bool:
     """ Check if a USB device is connected based on its ID in the format 'vendor_id:product_id' """
-    vendor_id, product_id = device_id.split(':')
-    connected  = usb.core.find(
-        backend=libusb1_backend,
-        idVendor=int(vendor_id),
-        idProduct=int(product_id)
+    return is_usb_connected_ids(*parse_usb_device_id(device_id))
+
+
+def is_usb_hotplug_supported() -> bool:
+    """ Check if the libusb backend can deliver hotplug events on this platform. """
+    if libusb1_backend is None:
+        return False
+    return bool(libusb1_backend.lib.libusb_has_capability(LIBUSB_CAP_HAS_HOTPLUG))
+
+
+def handle_usb_events():
+    """ Drive the libusb event loop so that registered hotplug callbacks get delivered. """
+    while not hotplug_stopped.is_set():
+        libusb1_backend.lib.libusb_handle_events(libusb1_backend.ctx)
+
+
+def stop_usb_event_handling():
+    """ Stop the libusb event thread so it is not left inside libusb while the backend is torn down at exit. """
+    if hotplug_thread is None:
+        return
+    hotplug_stopped.set()
+    libusb1_backend.lib.libusb_interrupt_event_handler(libusb1_backend.ctx)
+    hotplug_thread.join()
+
+
+def get_libusb_device_key(device: ctypes.c_void_p) -> Tuple[int, int, int, int]:
+    """
+        Returns the get_usb_device_key of a raw libusb device.
+        Only the device descriptor libusb cached during enumeration is read, so no USB transfers are made.
+    """
+    lib = libusb1_backend.lib
+    descriptor = _libusb_device_descriptor()  # the backend declares libusb_get_device_descriptor with pyusb's structure
+    lib.libusb_get_device_descriptor(device, ctypes.byref(descriptor))
+    return lib.libusb_get_bus_number(device), lib.libusb_get_device_address(device), descriptor.idVendor, descriptor.idProduct
+
+
+def register_usb_hotplug_callback(
+        callback: Callable[[int, Tuple[int, int, int, int]], None],
+        vendor_id: int = LIBUSB_HOTPLUG_MATCH_ANY,
+        product_id: int = LIBUSB_HOTPLUG_MATCH_ANY) -> int | None:
+    """
+        Register a callback which is passed the libusb hotplug event and the device key whenever a matching USB device arrives or leaves.
+        The callback runs on the libusb event thread, so it must not call back into libusb.
+        Returns the handle to pass to deregister_usb_hotplug_callback, or None if hotplug events are not supported,
+        in which case the caller should fall back to polling.
+    """
+    global hotplug_thread
+    if not is_usb_hotplug_supported():
+        return None
+
+    def on_hotplug(ctx, device, event, user_data):
+        callback(event, get_libusb_device_key(device))
+        return 0
+
+    lib = libusb1_backend.lib
+    lib.libusb_hotplug_register_callback.argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        libusb_hotplug_callback_fn, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)
+    ]
+    c_callback = libusb_hotplug_callback_fn(on_hotplug)
+    callback_handle = ctypes.c_int()
+    result = lib.libusb_hotplug_register_callback(
+        libusb1_backend.ctx,
+        LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED | LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT,
+        0,
+        vendor_id,
+        product_id,
+        LIBUSB_HOTPLUG_MATCH_ANY,
+        c_callback,
+        None,
+        ctypes.byref(callback_handle)
     )
-    return connected is not None
+    if result != 0:
+        return None
+    hotplug_callbacks[callback_handle.value] = c_callback
+    if hotplug_thread is None:
+        hotplug_thread = threading.Thread(target=handle_usb_events, daemon=True)
+        hotplug_thread.start()
+        atexit.register(stop_usb_event_handling)
+    return callback_handle.value
+
+
+def deregister_usb_hotplug_callback(callback_handle: int | None):
+    """ Stop delivering hotplug events to a callback registered by register_usb_hotplug_callback. """
+    if callback_handle is None:
+        return
+    lib = libusb1_backend.lib
+    lib.libusb_hotplug_deregister_callback.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.libusb_hotplug_deregister_callback(libusb1_backend.ctx, callback_handle)
+    hotplug_callbacks.pop(callback_handle, None)
 
 
 def poll_if_monitor_controllable(monitor: Monitor) -> bool:
-    """ Check if a monitor can be controlled by monitorcontrol. Return false if not. """
+    """
+        Check if a monitor can be controlled by monitorcontrol. Return false if not.
+        The capabilities are read once with no retries. Panels without DDC/CI, such as laptop eDP displays, fail this
+        or report no input sources, and are treated as uncontrollable rather than retried.
+    """
+    try:
+        capabilities = get_monitor_capabilities(monitor)
+    except Exception:
+        return False
+    return bool(capabilities.get('inputs'))
+
+
+@functools.cache
+def _cached_monitors() -> List[Monitor]:
+    return get_monitors()
+
+
+@functools.cache
+def _cached_caps(monitor: Monitor) -> dict:
+    key = get_monitor_cache_key(monitor)
+    if key is not None:
+        cached = get_cached_value(CAPABILITIES_CACHE_PATH, key)
+        if cached is not None and cached.get('inputs'):
+            return cached
     with monitor:
-        retry_count = 0
-        while retry_count < 5:
-            try:
-                str(monitor.get_input_source()).split('.')[1]
-                return True
-            except Exception:
-                retry_count += 1
-                time.sleep(0.5)
-    return False
+        capabilities = monitor.get_vcp_capabilities()
+    summary = {
+        'model': capabilities.get('model', 'Unknown'),
+        'inputs': [getattr(source, 'name', str(source)) for source in capabilities.get('inputs', [])]
+    }
+    if key is not None and summary['inputs']:
+        set_cached_value(CAPABILITIES_CACHE_PATH, key, summary)  # a summary without inputs may be truncated, so it is kept for this run only
+    return summary
 
 
-def get_monitor_id(monitor: Monitor) -> str:
+def get_cached_monitors(refresh: bool = False) -> List[Monitor]:
+    """
+        Returns the connected monitors. Monitors are only enumerated on first use,
+        or when refresh is set, which also drops any cached capabilities.
+    """
+    if refresh:
+        _cached_monitors.cache_clear()
+        _cached_caps.cache_clear()
+    return _cached_monitors()
+
+
+def get_monitor_capabilities(monitor: Monitor) -> dict:
+    """
+        Returns the model and input source names from the VCP capabilities of a monitor from get_cached_monitors().
+        Capabilities listing inputs are persisted by EDID, so DDC/CI is only queried the first time a monitor is seen.
+    """
+    return _cached_caps(monitor)
+
+
+def _get_monitor_id_win(monitor: Monitor) -> str:
+    return monitor.vcp.hmonitor.value  # transient value, changes any time devices are unplugged
+
+
+def _get_monitor_id_posix(monitor: Monitor) -> str:
+    return monitor.vcp.bus_number
+
+
+get_monitor_id = _get_monitor_id_win if WIN_PLATFORM else _get_monitor_id_posix
+
+
+def order_monitors(monitors: List[Monitor], configs: List[MonitorConfig] | None = None) -> List[Monitor]:
+    """
+        Orders monitors the way configs number them. Configs the setup recorded monitor_ids in number monitors
+        by I2C bus number, which does not depend on udev enumeration order. Older configs without any monitor_id
+        were numbered in enumeration order, so they keep it. Without configs, the order the setup would number them in is used.
+    """
     if WIN_PLATFORM:
-        return monitor.vcp.hmonitor.value  # transient value, changes any time devices are unplugged
+        return monitors  # HMONITOR values carry no order
+    if configs is None:
+        by_bus_number = any(get_monitor_cache_key(monitor) is not None for monitor in monitors)
     else:
-        return monitor.vcp.bus_number 
+        by_bus_number = any(config.monitor_id is not None for config in configs)
+    if not by_bus_number:
+        return monitors
+    return sorted(monitors, key=lambda monitor: int(get_monitor_id(monitor)))
+
+
+def read_cache_file(path: str) -> dict:
+    """ Reads a JSON cache file, treating a missing or unreadable file as an empty cache. """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache_file(path: str, data: dict):
+    """ Writes a JSON cache file. Failing to write a cache is not fatal, it only means probing again next run. """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+    except OSError as e:
+        logger.warning('Unable to write cache file %s: %s', path, e)
+
+
+def get_cached_value(path: str, key: str):
+    """ Returns the value stored under key in the cache file at path, or None if there is none. """
+    with cache_lock:
+        if path not in disk_caches:
+            disk_caches[path] = read_cache_file(path)
+        return disk_caches[path].get(key)
+
+
+def set_cached_value(path: str, key: str, value):
+    """ Stores value under key in the cache file at path. """
+    with cache_lock:
+        if path not in disk_caches:
+            disk_caches[path] = read_cache_file(path)
+        disk_caches[path][key] = value
+        write_cache_file(path, disk_caches[path])
+
+
+def clear_cache_files():
+    """ Removes all cached monitor probe results so that every monitor is probed again. """
+    with cache_lock:
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        disk_caches.clear()
+        session_controllable.clear()
+    _cached_caps.cache_clear()
+
+
+def read_linux_monitor_edid(bus_number: int) -> bytes | None:
+    """ Returns the EDID the kernel read for the display connector driven over the given I2C bus, if it exposes one. """
+    adapter = f'i2c-{bus_number}'
+    for connector in glob.glob('/sys/class/drm/card*-*'):
+        ddc_adapter = os.path.basename(os.path.realpath(os.path.join(connector, 'ddc')))
+        if ddc_adapter != adapter and not os.path.isdir(os.path.join(connector, adapter)):
+            continue
+        try:
+            with open(os.path.join(connector, 'edid'), 'rb') as f:
+                edid = f.read()
+        except OSError:
+            return None
+        return edid if len(edid) >= 128 else None
+    return None
+
 
+def get_monitor_cache_key(monitor: Monitor) -> str | None:
+    """
+        Returns a key identifying a monitor across runs, built from the manufacturer, product code and serial in its EDID.
+        Returns None if no EDID is available, e.g. on Windows where monitors are only identified by transient handles.
+    """
+    if WIN_PLATFORM:
+        return None
+    edid = read_linux_monitor_edid(monitor.vcp.bus_number)
+    if edid is None:
+        return None
+    vendor_code, = struct.unpack('>H', edid[8:10])
+    product_code, serial = struct.unpack('<HI', edid[10:16])
+    manufacturer = ''.join(chr(((vendor_code >> shift) & 0x1F) + ord('A') - 1) for shift in (10, 5, 0))
+    return f'{manufacturer}-{product_code:04X}-{serial:08X}'
 
-def build_monitor_config_map():
-    global monitor_config_map
-    monitors = get_monitors()
-    configs = KVM_CONFIG.monitors
-    if len(monitors) != len(KVM_CONFIG.monitors):
-        print('The number of connected monitors does not match the configured count. Retrying...')
-        time.sleep(1)
-        build_monitor_config_map()
-    monitor_config_map = {}
-    for monitor, config in zip(monitors, configs):
-        monitor_id = get_monitor_id(monitor)
-        controllable = poll_if_monitor_controllable(monitor)
-        config.is_controllable = controllable
-        monitor_config_map[monitor_id] = config
+
+def is_monitor_controllable(monitor: Monitor) -> bool:
+    """
+        Check if a monitor can be controlled by monitorcontrol.
+        Controllable monitors are persisted by EDID, so they are only probed the first time they are seen.
+        Failed probes are only remembered for this run, since a monitor in standby or switched away also fails them.
+        Monitors without an EDID key are probed once per run.
+    """
+    key = get_monitor_cache_key(monitor)
+    session_key = get_monitor_id(monitor) if key is None else key
+    if session_key in session_controllable:
+        return session_controllable[session_key]
+    if key is not None and get_cached_value(CONTROLLABLE_CACHE_PATH, key):
+        return True
+    controllable = poll_if_monitor_controllable(monitor)
+    session_controllable[session_key] = controllable
+    if controllable and key is not None:
+        set_cached_value(CONTROLLABLE_CACHE_PATH, key, True)
+    return controllable
+
+
+def match_monitors_to_configs(
+        monitors: List[Monitor],
+        configs: List[MonitorConfig],
+        previous: Dict[str, MonitorConfig] | None = None) -> List[Tuple[Monitor, MonitorConfig]]:
+    """
+        Pairs monitors with their configs. Configs recording a monitor_id are matched to the monitor with that ID,
+        then monitors keep the config they were paired with in previous, keyed by get_monitor_id,
+        and the remaining monitors and configs are paired up in order.
+        Identical monitors can share a monitor_id, so configs with the same ID are handed out in order too.
+        Monitors left over once every config is paired are omitted.
+    """
+    configs_by_id: Dict[str, List[MonitorConfig]] = {}
+    for config in configs:
+        if config.monitor_id is not None:
+            configs_by_id.setdefault(config.monitor_id, []).append(config)
+    matched: Dict[int, MonitorConfig] = {}
+    if configs_by_id:
+        for i, monitor in enumerate(monitors):
+            candidates = configs_by_id.get(get_monitor_cache_key(monitor))
+            if candidates:
+                matched[i] = candidates.pop(0)
+    if previous:
+        for i, monitor in enumerate(monitors):
+            config = previous.get(get_monitor_id(monitor))
+            if i not in matched and config is not None and not any(config is m for m in matched.values()):
+                matched[i] = config
+    remaining_configs = iter([config for config in configs if not any(config is m for m in matched.values())])
+    pairs = []
+    for i, monitor in enumerate(monitors):
+        config = matched[i] if i in matched else next(remaining_configs, None)
+        if config is not None:
+            pairs.append((monitor, config))
+    return pairs
 
 
-def get_config_for_monitor(monitor: Monitor) -> MonitorConfig | None:
-    global monitor_config_map
-    if monitor_config_map is None or len(monitor_config_map) == 0:
-        build_monitor_config_map()
-    monitor_id = get_monitor_id(monitor)
-    return monitor_config_map.get(monitor_id, None)
+def build_monitor_config_map(wait_for_all_monitors: bool = True):
+    """
+        Pairs the connected monitors with their configs, and precomputes the monitor_plan
+        of controllable monitors and their target inputs used whenever the usb device changes state.
+        If the number of connected monitors does not match the config and wait_for_all_monitors is set,
+        enumeration is retried with exponential backoff before giving up. Otherwise only the connected monitors are planned,
+        keeping the configs they were paired with before, since monitors in standby are not enumerated.
+        Monitors are probed concurrently once they are paired.
+        Rebuilds are serialized, and the new map and plan replace the old ones only once they are complete.
+    """
+    global monitor_config_map, monitor_plan
+    with monitor_config_lock:
+        configs = KVM_CONFIG.monitors
+        attempt_count = 0
+        while True:
+            monitors = order_monitors(get_cached_monitors(refresh=True), configs)
+            if len(monitors) == len(configs):
+                break
+            if not wait_for_all_monitors:
+                logger.warning('Found %s monitors but %s are configured. Only the connected monitors will be updated.', len(monitors), len(configs))
+                break
+            attempt_count += 1
+            if attempt_count >= MAX_MONITOR_MATCH_ATTEMPTS:
+                raise KVMException(f'Found {len(monitors)} monitors but {len(configs)} are configured after {attempt_count} attempts')
+            delay = min(30, 2 ** (attempt_count - 1))
+            logger.warning('The number of connected monitors does not match the configured count. Retrying in %ss...', delay)
+            time.sleep(delay)
+        pairs = match_monitors_to_configs(monitors, configs, monitor_config_map)
+        with ThreadPoolExecutor(max_workers=max(1, len(pairs))) as executor:
+            controllable_flags = list(executor.map(is_monitor_controllable, [monitor for monitor, _ in pairs]))
+        config_map = {}
+        plan = []
+        for (monitor, config), controllable in zip(pairs, controllable_flags):
+            config_map[get_monitor_id(monitor)] = config
+            config.is_controllable = controllable
+            if not controllable:
+                logger.warning('Monitor %s cannot be controlled. Skipping updates...', config.number)
+                continue
+            plan.append((monitor, config, config.on_connect_state.value, config.on_disconnect_state.value))
+        for config in configs:
+            if not any(config is paired for paired in config_map.values()):
+                config.last_known_state = None  # its monitor may come back at any input
+        monitor_config_map = config_map
+        monitor_plan = plan
+
+
+def ensure_monitor_config_map():
+    """ Builds the monitor_plan if it has not been built yet. Concurrent callers wait for a single build. """
+    if monitor_plan is None:
+        with monitor_config_lock:
+            if monitor_plan is None:
+                build_monitor_config_map()
 
 
 def get_monitor_state(monitor: Monitor, monitor_config: MonitorConfig) -> MonitorState:
-    """ Derives the provided monitor's MonitorState based on the configuration and current monitor state. """
+    """
+        Derives the provided monitor's MonitorState based on the configuration and current monitor state.
+        The monitor must already be open, so retries reuse the same VCP handle.
+    """
     monitor_config.on_connect_state  # TODO use this to derive the current state that may not be input specific
     attempt_count = 0
-    with monitor:
-        while attempt_count < 20:
-            try:
-                state = str(monitor.get_input_source()).split('.')[1]
-                state = MonitorState(state)
-                print(f'Monitor {monitor_config.number} current state is: {state}')
-                return state
-            except struct.error as e:
-                print(f'Error getting monitor state: {e}')
-                time.sleep(0.5)
-                attempt_count += 1
+    while attempt_count < 20:
+        try:
+            state = monitor.get_input_source().name
+            state = MonitorState(state)
+            logger.debug('Monitor %s current state is: %s', monitor_config.number, state.value)
+            return state
+        except struct.error as e:
+            logger.warning('Error getting monitor state: %s', e)
+            time.sleep(0.5)
+            attempt_count += 1
     raise KVMException(f'Error getting monitor state after {attempt_count} attempts')
 
 
-def update_monitor_state(mon_config: MonitorConfig, monitor: Monitor, desired_state: MonitorState):
-    """ Updates the provided monitor's state to match that of the desired_state MonitorState. """
-    with monitor:
-        print(f'Updating monitor {mon_config.number} state to {desired_state.value}')
-        monitor.set_input_source(desired_state.value)
+def update_monitor_state(mon_config: MonitorConfig, monitor: Monitor, desired_state: str):
+    """ Updates the provided, already open, monitor's state to match that of the desired_state MonitorState value. """
+    logger.info('Updating monitor %s state to %s', mon_config.number, desired_state)
+    monitor.set_input_source(desired_state)
+    mon_config.last_known_state = MonitorState(desired_state)
+
+
+def sync_monitor_state(monitor: Monitor, config: MonitorConfig, desired_state: str):
+    """
+        Opens a single monitor and brings it to the desired_state MonitorState value.
+        The monitor is opened once for the whole read-then-write cycle rather than once per VCP call.
+        With smart switching, the monitor's current input is read first and only changed if it differs.
+    """
+    try:
+        with monitor:
+            if KVM_CONFIG.enable_smart_switching:
+                current_state = get_monitor_state(monitor, config)
+                config.last_known_state = current_state
+                if current_state != desired_state:
+                    update_monitor_state(config, monitor, desired_state)
+                return
+            update_monitor_state(config, monitor, desired_state)
+    except Exception:
+        config.last_known_state = None
+        raise
+
+
+def apply_monitor_plan(usb_connected: bool, configs: List[MonitorConfig] | None = None) -> List[MonitorConfig]:
+    """
+        Brings every monitor in the monitor_plan, or only those paired with configs if given,
+        to its target state for whether the usb device is connected, and returns the configs of the monitors that failed.
+        Monitors last known to be at their target state are skipped without being opened when the shadowed state is trusted,
+        since nothing but this program is expected to change it.
+        Monitors are updated concurrently since each sits on its own DDC/CI bus, so one failing monitor does not hold up the others.
+    """
+    trust_last_known_state = KVM_CONFIG.enable_smart_switching or not KVM_CONFIG.force_resync_on_each_event
+    pending = []
+    for monitor, config, on_connect, on_disconnect in monitor_plan:
+        if configs is not None and not any(config is c for c in configs):
+            continue
+        desired_state = on_connect if usb_connected else on_disconnect
+        if trust_last_known_state and config.last_known_state == desired_state:
+            continue
+        pending.append((monitor, config, desired_state))
+    failed = []
+    if not pending:
+        return failed
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        futures = {
+            executor.submit(sync_monitor_state, monitor, config, desired_state): config
+            for monitor, config, desired_state in pending
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning('Error updating monitor %s: %s', futures[future].number, e)
+                failed.append(futures[future])
+    return failed
 
 
 def handle_monitor_updates(usb_connected: bool):
@@ -126,27 +644,27 @@ def handle_monitor_updates(usb_connected: bool):
         Handles the monitor updates based  on the KVM config and whether the usb device is connected.
         If the monitor is uncontrollable by monitorcontrol, omit making any changes to its state.
         If the KVM config has smart switching enabled, monitor states will only be updated as necessary.
-        Else, the monitor state will be forced to match the configred target state.
-    """
-    monitors: List[Monitor] = get_monitors()
-    for monitor in monitors:
-        config: MonitorConfig
-        config = get_config_for_monitor(monitor)
-        if config is None:
-            build_monitor_config_map()
-            handle_monitor_updates(usb_connected)
-            return
-        if not config.is_controllable:
-            print(f'Monitor {config.number} cannot be controlled. Skipping updates...')
-            continue
-        desired_state = config.on_connect_state if usb_connected else config.on_disconnect_state
-        if KVM_CONFIG.enable_smart_switching:
-            current_state = get_monitor_state(monitor, config)
-            if current_state != desired_state:
-                print(current_state != desired_state)
-                update_monitor_state(config, monitor, desired_state)
-            continue
-        update_monitor_state(config, monitor, desired_state)
+        Else, the monitor state will be forced to match the configred target state, unless force_resync_on_each_event is disabled.
+        If a planned monitor cannot be opened or updated, e.g. because its Windows handle went away when its input was switched
+        or it went into standby, the connected monitors are enumerated again and the failed ones are retried once.
+        Monitors that still fail are skipped until the next update, so the others keep switching.
+        While some configured monitors are missing, the monitors are enumerated again on every update to pick them back up.
+    """
+    ensure_monitor_config_map()
+    if len(monitor_config_map) < len(KVM_CONFIG.monitors):
+        build_monitor_config_map(wait_for_all_monitors=False)
+    failed = apply_monitor_plan(usb_connected)
+    if not failed:
+        return
+    logger.warning('Rebuilding the monitor list and retrying %s monitor(s)...', len(failed))
+    build_monitor_config_map(wait_for_all_monitors=False)
+    for config in apply_monitor_plan(usb_connected, failed):
+        logger.error('Monitor %s could not be updated. Skipping it until the next update.', config.number)
+
+
+def get_usb_poll_interval(idle_count: int, max_interval: float = 4.0) -> float:
+    """ Returns the delay before the next USB poll, backing off from 0.25s to max_interval the longer nothing has changed. """
+    return min(max_interval, 0.25 * 2 ** min(idle_count, 4))
 
 
 def run_kvm(kvm_config: KVMConfig):
@@ -155,13 +673,17 @@ def run_kvm(kvm_config: KVMConfig):
     global KVM_CONFIG
     KVM_CONFIG = kvm_config
     build_monitor_config_map()
-    usb_connected = is_usb_connected(kvm_config.usb_device)
+    vendor_id, product_id = parse_usb_device_id(kvm_config.usb_device)
+    start_usb_snapshot_thread()
+    version = usb_snapshot_version
+    usb_connected = is_usb_connected_ids(vendor_id, product_id)
     handle_monitor_updates(usb_connected)
     time.sleep(1)
     while True:
-        if usb_connected != is_usb_connected(kvm_config.usb_device):
+        version = wait_for_usb_snapshot(version)
+        if usb_connected != is_usb_connected_ids(vendor_id, product_id):
             usb_connected = not usb_connected
-            print(f"USB device {'connected ' if usb_connected else 'disconnected'}")
+            logger.info('USB device %s', 'connected' if usb_connected else 'disconnected')
             handle_monitor_updates(usb_connected)
 
 
@@ -169,22 +691,36 @@ def print_connected_monitor_info():
     """
         Prints the information for each connected monitor, including model and possible inputs.
         If a monitor cannot be controlled by monitorcontrol, a warning message will be displayed for that monitor.
+        Monitors are probed concurrently, but printed in order.
     """
-    print("---------------Monitors---------------")
-    for i, monitor in enumerate(get_monitors()):
-        if not poll_if_monitor_controllable(monitor):
-            print(f'Monitor {i}: Due to an unknown hardware or software issue, this monitor cannot be controlled via this program.')
-            continue
-        with monitor:
-            capabilities = monitor.get_vcp_capabilities()
+    def get_monitor_info(i: int, monitor: Monitor) -> str:
+        if not is_monitor_controllable(monitor):
+            return f'Monitor {i}: Due to an unknown hardware or software issue, this monitor cannot be controlled via this program.'
+        capabilities = get_monitor_capabilities(monitor)
         monitor_name = capabilities['model']
-        supported_inputs = [str(i).split('.')[1] for i in capabilities['inputs']]
-        print(f'Monitor {i} ({monitor_name}): {supported_inputs}')
+        supported_inputs = capabilities['inputs']
+        return f'Monitor {i} ({monitor_name}): {supported_inputs}'
+
+    print("---------------Monitors---------------")
+    monitors = order_monitors(get_cached_monitors())
+    if not monitors:
+        return
+    with ThreadPoolExecutor(max_workers=len(monitors)) as executor:
+        for info in executor.map(get_monitor_info, range(len(monitors)), monitors):
+            print(info)
+
+def get_usb_device_key(device: Device) -> Tuple[int, int, int, int]:
+    """ Returns a key identifying a connected USB device by its bus, address, vendor ID and product ID. """
+    return device.bus, device.address, device.idVendor, device.idProduct
+
 
-def get_connected_usb_devices() -> Set[Device]:
-    """ Returns a set of the connected USB devices. """
+def get_connected_usb_devices() -> Dict[Tuple[int, int, int, int], Device]:
+    """
+        Returns the connected USB devices keyed by get_usb_device_key.
+        Device objects are recreated on every enumeration, so the keys are what should be compared between calls.
+    """
     connected = usb.core.find(find_all=True, backend=libusb1_backend)
-    return set(connected)
+    return {get_usb_device_key(dev): dev for dev in connected}
 
 
 def try_get_string(dev: Device, index, langid = None, default_str_i0 = "Unknown", default_access_error = "Unknown"):
@@ -205,58 +741,133 @@ def try_get_string(dev: Device, index, langid = None, default_str_i0 = "Unknown"
     return string
 
 
+def read_sysfs_usb_strings(device: Device) -> Tuple[str | None, str | None]:
+    """
+        Returns the manufacturer and product strings the Linux kernel read when it enumerated the USB device.
+        Reading them from sysfs needs no USB transfers and no access to the device. Strings that are unavailable are None.
+    """
+    if not device.port_numbers:
+        return None, None
+    device_path = os.path.join('/sys/bus/usb/devices', f"{device.bus}-{'.'.join(str(port) for port in device.port_numbers)}")
+    strings = []
+    for attribute in ('manufacturer', 'product'):
+        try:
+            with open(os.path.join(device_path, attribute), 'r') as f:
+                strings.append(f.read().strip() or None)
+        except OSError:
+            strings.append(None)
+    return strings[0], strings[1]
+
+
 def get_usb_device_info_string(device: Device):
-    """ Return a summary of a USB device. """
-    manufacturer = try_get_string(device, device.iManufacturer)
-    dev_name = try_get_string(device, device.iProduct)
+    """
+        Return a summary of a USB device.
+        The manufacturer and product strings are only looked up the first time the device is seen,
+        preferring the copies cached by the OS and only then reading the string descriptors from the device.
+        Entries for unplugged devices are dropped with forget_usb_device.
+    """
+    key = get_usb_device_key(device)
+    strings = usb_string_cache.get(key)
+    if strings is None:
+        manufacturer, dev_name = read_sysfs_usb_strings(device)
+        strings = (
+            manufacturer or try_get_string(device, device.iManufacturer),
+            dev_name or try_get_string(device, device.iProduct)
+        )
+        usb_string_cache[key] = strings
+    manufacturer, dev_name = strings
     return f"{device.idVendor}:{device.idProduct} ({manufacturer} {dev_name})"
 
 
+def forget_usb_device(info_by_key: Dict[Tuple[int, int, int, int], str], key: Tuple[int, int, int, int]) -> str:
+    """ Drops an unplugged device from info_by_key and the string cache, returning its last known summary. """
+    usb_string_cache.pop(key, None)
+    return info_by_key.pop(key, f"{key[2]}:{key[3]}")
+
+
+def watch_usb_device_events(info_by_key: Dict[Tuple[int, int, int, int], str], usb_events: queue.Queue):
+    """ Prints added and removed devices as their hotplug events arrive on usb_events. """
+    while True:
+        event, key = usb_events.get()
+        bus, address, _, _ = key
+        if event == LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED and key not in info_by_key:
+            device = usb.core.find(backend=libusb1_backend, bus=bus, address=address)
+            if device is None:
+                continue
+            info_by_key[key] = get_usb_device_info_string(device)
+            print(f"Connected: {[info_by_key[key]]}    Disconnected: []")
+        elif event == LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT:
+            info = forget_usb_device(info_by_key, key)
+            print(f"Connected: []    Disconnected: {[info]}")
+
+
+def poll_usb_device_changes(info_by_key: Dict[Tuple[int, int, int, int], str]):
+    """
+        Polls for added and removed devices to print, for platforms without hotplug support.
+        The poll interval backs off to at most 1s while nothing changes, so the finder stays responsive.
+    """
+    idle_count = 0
+    while True:
+        time.sleep(get_usb_poll_interval(idle_count, max_interval=1.0))
+        new_connected = get_connected_usb_devices()
+        removed = [forget_usb_device(info_by_key, key) for key in (info_by_key.keys() - new_connected.keys())]
+        added = []
+        for key in (new_connected.keys() - info_by_key.keys()):
+            info_by_key[key] = get_usb_device_info_string(new_connected[key])
+            added.append(info_by_key[key])
+        if added or removed:
+            print(f"Connected: {added}    Disconnected: {removed}")
+            idle_count = 0
+        else:
+            idle_count += 1
+
+
 def run_usb_identifier():
     """ 
         Run a USB identifier which prints all connected USB devices,
-        then polls for added and removed devices to print.
+        then waits for added and removed devices to print.
+        info_by_key holds the summary of every connected device, so removed devices are described without touching them.
     """
+    usb_events = queue.Queue()
+    hotplug_handle = register_usb_hotplug_callback(lambda event, key: usb_events.put((event, key)))
     print("---------------USB Devices------------")
-    connected = get_connected_usb_devices()
-    for c in connected:
-        print(get_usb_device_info_string(c))
+    info_by_key = {key: get_usb_device_info_string(dev) for key, dev in get_connected_usb_devices().items()}
+    for info in info_by_key.values():
+        print(info)
     print("--------------------------------------")
     print("\n\nRunning device finder -- press Ctrl+C to quit...")
     print("Plug in or unplug a device to view its ID...")
     try:
-        while True:
-            time.sleep(0.25)
-            new_connected = get_connected_usb_devices()
-            if connected != new_connected:
-                removed = [get_usb_device_info_string(dev) for dev in (connected - new_connected)]
-                added = [get_usb_device_info_string(dev) for dev in (new_connected - connected)]
-                print(f"Connected: {added}    Disconnected: {removed}")
-            connected = new_connected
+        if hotplug_handle is not None:
+            watch_usb_device_events(info_by_key, usb_events)
+        else:
+            poll_usb_device_changes(info_by_key)
     except KeyboardInterrupt:
         print("Exiting device finder")
+    finally:
+        deregister_usb_hotplug_callback(hotplug_handle)
 
 
 def run_config_creator():
     """ Runs the initial setup config creator to create a config.json file for KVM configuration. """
-    monitors = get_monitors()
+    monitors = order_monitors(get_cached_monitors())
     usb_device_id = input('Enter the USB device ID to monitor: ')
     print("--------------------------------------")
     print(f'Supported states are: {[state.value for state in MonitorState]}')
     monitor_configs: List[MonitorConfig] = []
     for i, monitor in enumerate(monitors):
-        controllable = poll_if_monitor_controllable(monitor)
+        controllable = is_monitor_controllable(monitor)
         monitor_name = 'Unknown'
         if controllable:
-            with monitor:
-                monitor_name = monitor.get_vcp_capabilities()['model']
+            monitor_name = get_monitor_capabilities(monitor)['model']
         on_connect_state = MonitorState(input(f'Monitor {i} ({monitor_name}) on_connect state: '))
         on_disconnect_state = MonitorState(input(f'Monitor {i} ({monitor_name}) on_disconnect state: '))
         monitor_configs.append(MonitorConfig(
             number=i,
             name=monitor_name,
             on_connect_state=on_connect_state,
-            on_disconnect_state=on_disconnect_state
+            on_disconnect_state=on_disconnect_state,
+            monitor_id=get_monitor_cache_key(monitor)
         ))
     enable_smart = 'Y' == input('Would you like to enable smart state switching? (Y/N): ').upper()
     kvm_config = KVMConfig(
@@ -279,17 +890,35 @@ def run_initial_setup():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', action='store_true', default=False, help='Use this flag to discard cached monitor probe results and probe every monitor again.')
+    args, _ = parser.parse_known_args()  # the documented -f, -c, -d and -v flags are not wired up yet, so ignore them as before
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.r:
+        clear_cache_files()
     # run_initial_setup()
     kvm_config: KVMConfig
-    with open('auto_config.json', 'r') as f:
-        config_text = f.read()
-        kvm_config = KVMConfig.model_validate_json(config_text)
-    try:
-        run_kvm(kvm_config)
-    except KVMException as e:
-        print(f'An error occurred while running KVM: {e}. Exiting.')
-    except Exception:
-        run_kvm(kvm_config)
+    with open('auto_config.json', 'rb') as f:
+        kvm_config = KVMConfig.model_validate_json(f.read())
+    restart_count = 0
+    while True:
+        started_at = time.monotonic()
+        try:
+            run_kvm(kvm_config)
+            break
+        except KVMException as e:
+            logger.error('An error occurred while running KVM: %s. Exiting.', e)
+            break
+        except Exception:
+            if time.monotonic() - started_at >= KVM_HEALTHY_RUN_SECONDS:
+                restart_count = 0  # only consecutive quick failures count towards giving up
+            restart_count += 1
+            if restart_count > MAX_KVM_RESTARTS:
+                logger.exception('KVM failed %s times. Exiting.', restart_count)
+                break
+            backoff = min(60, 2 ** restart_count)
+            logger.exception('Unexpected error while running KVM. Restarting in %ss (%s/%s)...', backoff, restart_count, MAX_KVM_RESTARTS)
+            time.sleep(backoff)
 
 
 # if __name__ == "__main__":